@@ -5,18 +5,32 @@ iLovePDF-level compression using Ghostscript
 Render.com deployment ready
 """
 
+import io
 import os
 import uuid
+import hashlib
+import shutil
 import subprocess
 import tempfile
 import logging
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, send_file
+import queue
+import sqlite3
+import orjson
+from flask import Flask, Response, request, send_file, stream_with_context
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget, ValueTarget
 import threading
 import time
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,118 +39,221 @@ app = Flask(__name__)
 CORS(app, origins=["https://quickutil.app", "https://quickutil-d2998.web.app", "http://localhost:3000"])
 
 # Configuration
-UPLOAD_FOLDER = '/tmp/uploads'
 COMPRESSED_FOLDER = '/tmp/compressed'
+METADATA_DB = '/tmp/meta.db'  # Shared by all gunicorn workers
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX')  # e.g. /internal/ when behind nginx
 MAX_CONTENT_LENGTH = 5 * 1024 * 1024  # 5MB max file size (Render.com free tier limit)
+FORM_OVERHEAD = 64 * 1024  # Multipart boundaries and form fields on top of the file
 CLEANUP_INTERVAL = 3600  # 1 hour cleanup interval
+GS_WORKERS = int(os.environ.get('GS_WORKERS', 1))  # Concurrent Ghostscript jobs per gunicorn worker
+GS_STANDBY = int(os.environ.get('GS_STANDBY', 2))  # Warm Ghostscript processes per gunicorn worker, all qualities
+GS_BUFFER_SPACE = int(os.environ.get('GS_BUFFER_SPACE', 1500000000))  # Keep images in RAM, headroom on a 2GB instance
+COPY_BUFSIZE = 1024 * 1024  # 1MB chunks for upload/output copies
+STREAM_CHUNK_SIZE = 256 * 1024  # 256KB chunks when streaming Ghostscript output
+
+# Reject oversized request bodies before reading them
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH + FORM_OVERHEAD
 
 # Ensure directories exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(COMPRESSED_FOLDER, exist_ok=True)
 
-# Store compressed files info
-compressed_files = {}
+class UploadTarget(BaseTarget):
+    """
+    streaming-form-data target collecting the upload in memory
+    
+    Uploads are capped at MAX_CONTENT_LENGTH, so they never touch /tmp
+    before being hashed and piped to Ghostscript.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.stream = io.BytesIO()
+        self.finished = False
+
+    def on_data_received(self, chunk):
+        if self.stream.tell() + len(chunk) > MAX_CONTENT_LENGTH:
+            raise UploadTooLarge(self.stream.tell() + len(chunk))
+        self.stream.write(chunk)
+
+    def on_finish(self):
+        self.stream.seek(0)
+        self.finished = True
+
+# Store compressed files info in SQLite so every worker sees every download
+db = sqlite3.connect(METADATA_DB, check_same_thread=False, isolation_level=None)
+db.row_factory = sqlite3.Row
+db.execute('PRAGMA journal_mode=WAL')
+db.execute('''
+    CREATE TABLE IF NOT EXISTS files (
+        id TEXT PRIMARY KEY,
+        compressed_path TEXT NOT NULL,
+        created REAL NOT NULL,
+        original_filename TEXT NOT NULL,
+        original_size INTEGER NOT NULL,
+        compressed_size INTEGER NOT NULL,
+        compression_ratio REAL NOT NULL,
+        quality TEXT NOT NULL,
+        compression_time REAL NOT NULL,
+        digest TEXT NOT NULL
+    )
+''')
+db.execute('CREATE INDEX IF NOT EXISTS files_created ON files (created)')
+db.execute('CREATE INDEX IF NOT EXISTS files_digest ON files (digest, quality)')
+db_lock = threading.Lock()
+
+# Ghostscript concurrency limits per process: GS_WORKERS jobs run at once,
+# as many again may wait for a slot, anything beyond is rejected with 503
+gs_worker_slots = threading.BoundedSemaphore(GS_WORKERS)
+gs_admission_slots = threading.BoundedSemaphore(GS_WORKERS * 2)
+
+def json_response(payload, status=200):
+    """JSON response serialized with orjson instead of Flask's stdlib json"""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
+class UploadTooLarge(Exception):
+    """Raised when an upload stream exceeds MAX_CONTENT_LENGTH"""
+
+class ServerBusy(Exception):
+    """Raised when all Ghostscript slots are taken"""
+
+def fingerprint_upload(stream):
+    """
+    Content hash of an in-memory upload, used as the dedup key
+    
+    The BytesIO buffer is hashed in place without copying; BLAKE3's SIMD
+    implementation is used when installed, SHA-256 otherwise.
+    """
+    if blake3 is not None:
+        with stream.getbuffer() as view:
+            return 'blake3:' + blake3.blake3(view).hexdigest()
+    return 'sha256:' + hashlib.file_digest(stream, 'sha256').hexdigest()
+
+# Ghostscript probe result, cached so /health doesn't fork gs on every poll
+gs_available = None
+gs_version = None
+
+def probe_ghostscript():
+    """Run 'gs --version' once and cache availability and version"""
+    global gs_available, gs_version
+    try:
+        result = subprocess.run(['gs', '--version'], capture_output=True, text=True, timeout=5, check=True)
+        gs_available = True
+        gs_version = result.stdout.strip()
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+        gs_available = False
+        gs_version = "Not available"
+
+def invalidate_ghostscript_probe():
+    """Force a re-probe on next check, e.g. after Ghostscript failed"""
+    global gs_available
+    gs_available = None
 
 def is_ghostscript_available():
     """Check if Ghostscript is available"""
-    try:
-        subprocess.run(['gs', '--version'], capture_output=True, check=True)
-        return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        return False
+    if gs_available is None:
+        probe_ghostscript()
+    return gs_available
 
 def get_ghostscript_version():
     """Get Ghostscript version"""
-    try:
-        result = subprocess.run(['gs', '--version'], capture_output=True, text=True, check=True)
-        return result.stdout.strip()
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        return "Not available"
+    if gs_available is None:
+        probe_ghostscript()
+    return gs_version
 
-def compress_pdf_ghostscript(input_path, output_path, quality='ebook'):
+probe_ghostscript()
+
+def supports_legacy_pdf_interpreter():
     """
-    Compress PDF using Ghostscript with iLovePDF-level quality
+    Check whether -dNEWPDF=false may be passed
     
-    Quality levels:
-    - screen: Maximum compression (80-90% reduction)
-    - ebook: High compression (60-80% reduction) 
-    - printer: Medium compression (40-60% reduction)
-    - prepress: Light compression (20-40% reduction)
+    Ghostscript 9.55 introduced the NEWPDF switch; older releases reject it
+    and releases from 10.03 on no longer ship the legacy interpreter.
     """
-    
-    # Ghostscript compression settings
-    quality_settings = {
-        'screen': {
-            'dPDFSETTINGS': '/screen',
-            # OPTIMIZED compression settings - Better quality balance
-            'dDownsampleColorImages': 'true',
-            'dColorImageResolution': '150',  # Increased from 72 to 150 DPI
-            'dColorImageDownsampleThreshold': '1.5',
-            'dColorImageDownsampleType': '/Bicubic',
-            'dColorACSImageDict': '<<  /QFactor 0.4 /Blend 1 /HSamples [2 1 1 2] /VSamples [2 1 1 2] >>',  # Improved from 0.15 to 0.4
-            'dDownsampleGrayImages': 'true', 
-            'dGrayImageResolution': '150',  # Increased from 72 to 150 DPI
-            'dGrayImageDownsampleThreshold': '1.5',
-            'dGrayImageDownsampleType': '/Bicubic',
-            'dGrayACSImageDict': '<<  /QFactor 0.4 /Blend 1 /HSamples [2 1 1 2] /VSamples [2 1 1 2] >>',  # Improved from 0.15 to 0.4
-            'dDownsampleMonoImages': 'true',
-            'dMonoImageResolution': '150',  # Increased from 72 to 150 DPI
-            'dMonoImageDownsampleThreshold': '1.0',
-            'dMonoImageDownsampleType': '/Subsample',
-            'dCompressPages': 'true',
-            'dUseFlateCompression': 'true',
-            'dOptimize': 'true',
-            'dMaxSubsetPct': '100',
-            'dSubsetFonts': 'true',
-            'dEmbedAllFonts': 'true',
-            # BALANCED COMPRESSION SETTINGS
-            'dDetectDuplicateImages': 'true',
-            'dCompressFonts': 'true',
-            'dPreserveEPSInfo': 'false',
-            'dPreserveOPIComments': 'false',
-            'dPreserveHalftoneInfo': 'false',
-            'dPreserveCopyPage': 'false',
-            'dCreateJobTicket': 'false',
-            'dDoThumbnails': 'false',
-            'dCannotEmbedFontPolicy': '/Warning',
-            'dAutoFilterColorImages': 'true',
-            'dAutoFilterGrayImages': 'true',
-            'dColorConversionStrategy': '/LeaveColorUnchanged'
-        },
-        'ebook': {
-            'dPDFSETTINGS': '/ebook',
-            'dDownsampleColorImages': 'true',
-            'dColorImageResolution': '150',
-            'dDownsampleGrayImages': 'true',
-            'dGrayImageResolution': '150', 
-            'dDownsampleMonoImages': 'true',
-            'dMonoImageResolution': '150',
-            'dCompressPages': 'true',
-            'dUseFlateCompression': 'true',
-            'dOptimize': 'true'
-        },
-        'printer': {
-            'dPDFSETTINGS': '/printer',
-            'dDownsampleColorImages': 'true',
-            'dColorImageResolution': '300',
-            'dDownsampleGrayImages': 'true',
-            'dGrayImageResolution': '300',
-            'dDownsampleMonoImages': 'true', 
-            'dMonoImageResolution': '300',
-            'dCompressPages': 'true',
-            'dOptimize': 'true'
-        },
-        'prepress': {
-            'dPDFSETTINGS': '/prepress',
-            'dCompressPages': 'true',
-            'dOptimize': 'true'
-        }
+    try:
+        version = tuple(int(part) for part in get_ghostscript_version().split('.')[:2])
+    except ValueError:
+        return False
+    return (9, 55) <= version < (10, 3)
+
+# Ghostscript compression settings
+#
+# Quality levels:
+# - screen: Maximum compression (80-90% reduction)
+# - ebook: High compression (60-80% reduction)
+# - printer: Medium compression (40-60% reduction)
+# - prepress: Light compression (20-40% reduction)
+QUALITY_SETTINGS = {
+    'screen': {
+        'dPDFSETTINGS': '/screen',
+        # OPTIMIZED compression settings - Better quality balance
+        'dDownsampleColorImages': 'true',
+        'dColorImageResolution': '150',  # Increased from 72 to 150 DPI
+        'dColorImageDownsampleThreshold': '1.5',
+        'dColorImageDownsampleType': '/Bicubic',
+        'dColorACSImageDict': '<<  /QFactor 0.4 /Blend 1 /HSamples [2 1 1 2] /VSamples [2 1 1 2] >>',  # Improved from 0.15 to 0.4
+        'dDownsampleGrayImages': 'true', 
+        'dGrayImageResolution': '150',  # Increased from 72 to 150 DPI
+        'dGrayImageDownsampleThreshold': '1.5',
+        'dGrayImageDownsampleType': '/Bicubic',
+        'dGrayACSImageDict': '<<  /QFactor 0.4 /Blend 1 /HSamples [2 1 1 2] /VSamples [2 1 1 2] >>',  # Improved from 0.15 to 0.4
+        'dDownsampleMonoImages': 'true',
+        'dMonoImageResolution': '150',  # Increased from 72 to 150 DPI
+        'dMonoImageDownsampleThreshold': '1.0',
+        'dMonoImageDownsampleType': '/Subsample',
+        'dCompressPages': 'true',
+        'dUseFlateCompression': 'true',
+        'dOptimize': 'true',
+        'dMaxSubsetPct': '100',
+        'dSubsetFonts': 'true',
+        'dEmbedAllFonts': 'true',
+        # BALANCED COMPRESSION SETTINGS
+        'dDetectDuplicateImages': 'true',
+        'dCompressFonts': 'true',
+        'dPreserveEPSInfo': 'false',
+        'dPreserveOPIComments': 'false',
+        'dPreserveHalftoneInfo': 'false',
+        'dPreserveCopyPage': 'false',
+        'dCreateJobTicket': 'false',
+        'dDoThumbnails': 'false',
+        'dCannotEmbedFontPolicy': '/Warning',
+        'dAutoFilterColorImages': 'true',
+        'dAutoFilterGrayImages': 'true',
+        'dColorConversionStrategy': '/LeaveColorUnchanged'
+    },
+    'ebook': {
+        'dPDFSETTINGS': '/ebook',
+        'dDownsampleColorImages': 'true',
+        'dColorImageResolution': '150',
+        'dDownsampleGrayImages': 'true',
+        'dGrayImageResolution': '150', 
+        'dDownsampleMonoImages': 'true',
+        'dMonoImageResolution': '150',
+        'dCompressPages': 'true',
+        'dUseFlateCompression': 'true',
+        'dOptimize': 'true'
+    },
+    'printer': {
+        'dPDFSETTINGS': '/printer',
+        'dDownsampleColorImages': 'true',
+        'dColorImageResolution': '300',
+        'dDownsampleGrayImages': 'true',
+        'dGrayImageResolution': '300',
+        'dDownsampleMonoImages': 'true', 
+        'dMonoImageResolution': '300',
+        'dCompressPages': 'true',
+        'dOptimize': 'true'
+    },
+    'prepress': {
+        'dPDFSETTINGS': '/prepress',
+        'dCompressPages': 'true',
+        'dOptimize': 'true'
     }
-    
-    settings = quality_settings.get(quality, quality_settings['ebook'])
-    
+}
+
+def build_base_ghostscript_args():
+    """Quality-independent Ghostscript arguments"""
     # Build Ghostscript command with MAXIMUM compression optimization
-    cmd = [
+    args = [
         'gs',
         '-sDEVICE=pdfwrite',
         '-dNOPAUSE',
@@ -144,42 +261,280 @@ def compress_pdf_ghostscript(input_path, output_path, quality='ebook'):
         '-dBATCH',
         '-dSAFER',
         '-dNOGC',  # Disable garbage collection for speed
-        '-dNumRenderingThreads=1',  # Single thread for memory efficiency
-        f'-sOutputFile={output_path}'
+        f'-dBufferSpace={GS_BUFFER_SPACE}'  # Don't spool large images to /tmp
     ]
     
-    # Add quality-specific settings
-    for key, value in settings.items():
-        cmd.append(f'-{key}={value}')
+    if supports_legacy_pdf_interpreter():
+        # Older PDF interpreter is faster for compression workloads
+        args.append('-dNEWPDF=false')
+        logger.info(f"📄 Ghostscript {get_ghostscript_version()}: using legacy PDF interpreter")
+    else:
+        logger.info(f"📄 Ghostscript {get_ghostscript_version()}: using default PDF interpreter")
     
-    # Add input file
-    cmd.append(input_path)
+    return tuple(args)
+
+# Command parts precompiled at import, per job only the output args are added
+GS_BASE_ARGS = build_base_ghostscript_args()
+GS_QUALITY_ARGS = {
+    quality: tuple(f'-{key}={value}' for key, value in settings.items())
+    for quality, settings in QUALITY_SETTINGS.items()
+}
+
+def build_ghostscript_command(output_path, quality='ebook'):
+    """
+    Build Ghostscript command reading the PDF from stdin
     
-    logger.info(f"🔧 Compressing with Ghostscript: {quality} quality")
-    logger.info(f"📝 Command: {' '.join(cmd[:10])}...")  # Log first 10 parts for security
+    output_path may be '-' to write the compressed PDF to stdout.
+    """
+    output_args = (f'-sOutputFile={output_path}',)
+    if output_path == '-':
+        # Keep interpreter messages out of the PDF written to stdout
+        output_args += ('-sstdout=%stderr',)
     
+    # Read input from stdin
+    quality_args = GS_QUALITY_ARGS.get(quality, GS_QUALITY_ARGS['ebook'])
+    return GS_BASE_ARGS + quality_args + output_args + ('-',)
+
+# Pools of pre-started Ghostscript processes waiting on stdin, per quality.
+# GS_STANDBY is shared by all qualities: standby_slots counts the warm
+# processes each quality holds, queued or pending refill.
+standby_pools = {}
+standby_slots = {}
+standby_lock = threading.Lock()
+standby_refills = queue.Queue()
+
+def spawn_ghostscript(quality):
+    """
+    Start Ghostscript for the given quality, writing the PDF to stdout
+    
+    The process parses its init files right away and then blocks reading
+    stdin, so interpreter startup is paid before a job arrives.
+    """
+    stderr_file = tempfile.TemporaryFile()
     try:
-        # Run Ghostscript compression with memory optimization
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=120,  # 2 minutes timeout (Render.com optimization)
-            check=True
+        proc = subprocess.Popen(
+            build_ghostscript_command('-', quality),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=stderr_file
         )
+    except OSError:
+        stderr_file.close()
+        invalidate_ghostscript_probe()
+        raise
+    return proc, stderr_file
+
+def retire_ghostscript(standby):
+    """Stop an idle standby process and release its stderr file"""
+    proc, stderr_file = standby
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+    proc.stdout.close()
+    stderr_file.close()
+
+def claim_standby_slot(quality):
+    """
+    Give quality a warm slot, from the free budget or from another quality
+    
+    Called with standby_lock held when quality has no slots at all, so the
+    budget follows the qualities actually in use.
+    """
+    if sum(standby_slots.values()) < GS_STANDBY:
+        standby_slots[quality] = 1
+        standby_refills.put(quality)
+        return
+    
+    for other in sorted(standby_slots, key=standby_slots.get, reverse=True):
+        if other == quality or standby_slots[other] == 0:
+            continue
+        try:
+            idle = standby_pools[other].get_nowait()
+        except queue.Empty:
+            continue
+        retire_ghostscript(idle)
+        standby_slots[other] -= 1
+        standby_slots[quality] = 1
+        standby_refills.put(quality)
+        return
+
+def acquire_ghostscript(quality):
+    """
+    Take a warm process for quality from its pool
+    
+    Every process taken is replaced by the refill thread, so requests never
+    wait on fork+exec unless the pool has run dry.
+    """
+    with standby_lock:
+        pool = standby_pools.setdefault(quality, queue.Queue())
+        standby_slots.setdefault(quality, 0)
+    
+    while True:
+        try:
+            standby = pool.get_nowait()
+        except queue.Empty:
+            break
+        
+        standby_refills.put(quality)
+        if standby[0].poll() is None:
+            return standby
+        
+        # Standby died while idle, discard it
+        retire_ghostscript(standby)
+    
+    with standby_lock:
+        if standby_slots[quality] == 0:
+            claim_standby_slot(quality)
+    
+    # Pool ran dry, pending refills will top it up again
+    return spawn_ghostscript(quality)
+
+def start_standby_refill():
+    """Start background thread spawning replacement Ghostscript processes"""
+    def refill_loop():
+        while True:
+            quality = standby_refills.get()
+            try:
+                standby_pools[quality].put(spawn_ghostscript(quality))
+            except Exception as e:
+                logger.error(f"❌ Ghostscript standby spawn error: {str(e)}")
+                # Give the slot back so the budget doesn't leak
+                with standby_lock:
+                    standby_slots[quality] -= 1
+                time.sleep(1)
+    
+    refill_thread = threading.Thread(target=refill_loop, daemon=True)
+    refill_thread.start()
+
+start_standby_refill()
+
+class GhostscriptJob:
+    """
+    One compression run on a warm Ghostscript process
+    
+    The upload is fed to stdin from a helper thread while the caller reads
+    the compressed PDF from stdout, so a full pipe can't deadlock either side.
+    """
+
+    def __init__(self, input_stream, quality='ebook'):
+        if not gs_admission_slots.acquire(blocking=False):
+            raise ServerBusy()
+        try:
+            gs_worker_slots.acquire()
+            self.proc, self.stderr_file = acquire_ghostscript(quality)
+        except BaseException:
+            gs_worker_slots.release()
+            gs_admission_slots.release()
+            raise
+        self.finished = False
+        self.stdout = self.proc.stdout
+        self.timed_out = False
+        self.aborted = False
+        
+        # 2 minutes timeout (Render.com optimization). For streamed jobs this
+        # includes the client's download time: gs blocks on a full stdout pipe
+        # until the response is read, and a kill ends the body early.
+        self.watchdog = threading.Timer(120, self._timeout)
+        self.watchdog.start()
+        
+        self.feeder = threading.Thread(target=self._feed, args=(input_stream,), daemon=True)
+        self.feeder.start()
+
+    def _timeout(self):
+        self.timed_out = True
+        self.proc.kill()
+
+    def _feed(self, input_stream):
+        try:
+            shutil.copyfileobj(input_stream, self.proc.stdin, COPY_BUFSIZE)
+        except (BrokenPipeError, ValueError):
+            pass  # Ghostscript exited early, stderr tells why
+        finally:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def finish(self):
+        """Wait for Ghostscript to exit, returns (success, stderr)"""
+        self.proc.wait()
+        self.watchdog.cancel()
+        self.feeder.join()
         
-        logger.info("✅ Ghostscript compression successful")
-        return True
+        if not self.finished:
+            self.finished = True
+            self.stdout.close()
+            self.stderr_file.seek(0)
+            self.stderr = self.stderr_file.read().decode(errors='replace')
+            self.stderr_file.close()
+            gs_worker_slots.release()
+            gs_admission_slots.release()
         
-    except subprocess.TimeoutExpired:
+        stderr = self.stderr
+        success = self.proc.returncode == 0 and not self.timed_out
+        if not success and not self.timed_out and not self.aborted:
+            # gs may have been removed mid-run, check again on next request
+            invalidate_ghostscript_probe()
+        return success, stderr
+
+    def abort(self):
+        """Kill Ghostscript, e.g. when the client went away mid-stream"""
+        self.aborted = True
+        if self.proc.poll() is None:
+            self.proc.kill()
+        return self.finish()
+
+def compress_pdf_ghostscript(input_stream, output_path, quality='ebook'):
+    """
+    Compress PDF using Ghostscript with iLovePDF-level quality
+    
+    The PDF is read from input_stream and piped into a warm Ghostscript
+    process, so the upload never has to be written to a temp file.
+    """
+    logger.info(f"🔧 Compressing with Ghostscript: {quality} quality")
+    
+    job = GhostscriptJob(input_stream, quality)
+    try:
+        with open(output_path, 'wb', buffering=COPY_BUFSIZE) as output_file:
+            shutil.copyfileobj(job.stdout, output_file, COPY_BUFSIZE)
+        success, stderr = job.finish()
+    except Exception as e:
+        job.abort()
+        logger.error(f"❌ Ghostscript compression error: {str(e)}")
+        return False
+    
+    if job.timed_out:
         logger.error("❌ Ghostscript compression timeout")
         return False
-    except subprocess.CalledProcessError as e:
-        logger.error(f"❌ Ghostscript compression failed: {e.stderr}")
+    if not success:
+        logger.error(f"❌ Ghostscript compression failed: {stderr}")
         return False
-    except Exception as e:
-        logger.error(f"❌ Ghostscript compression error: {str(e)}")
+    
+    logger.info("✅ Ghostscript compression successful")
+    return True
+
+def link_cached_compression(digest, quality, output_path):
+    """
+    Hard-link the result of an identical earlier upload to output_path
+    
+    Every download id gets its own link, so expiring one entry doesn't
+    remove the file another entry still points to.
+    """
+    with db_lock:
+        cached = db.execute(
+            'SELECT compressed_path FROM files WHERE digest = ? AND quality = ? '
+            'ORDER BY created DESC LIMIT 1',
+            (digest, quality)
+        ).fetchone()
+    
+    if cached is None:
         return False
+    
+    try:
+        os.link(cached['compressed_path'], output_path)
+    except OSError:
+        return False  # Expired in the meantime
+    return True
 
 def calculate_compression_ratio(original_size, compressed_size):
     """Calculate compression ratio percentage"""
@@ -187,39 +542,105 @@ def calculate_compression_ratio(original_size, compressed_size):
         return 0
     return ((original_size - compressed_size) / original_size) * 100
 
+PDF_EXTENSION = int.from_bytes(b'.pdf', 'little')
+ASCII_LOWERCASE_BITS = 0x20202020
+
+def is_pdf_filename(filename):
+    """
+    Case-insensitive '.pdf' suffix check on the last 4 bytes packed as one int
+    
+    OR-ing 0x20 into each byte lowercases ASCII letters and leaves '.' as is,
+    so no lowercased copy of the filename is needed.
+    """
+    suffix = filename[-4:].encode('ascii', 'ignore')
+    return len(suffix) == 4 and (int.from_bytes(suffix, 'little') | ASCII_LOWERCASE_BITS) == PDF_EXTENSION
+
+def get_pdf_upload():
+    """
+    Parse and validate uploaded PDF and compression quality
+    
+    The multipart body is parsed incrementally by streaming-form-data
+    instead of werkzeug's form parser, so request.files is never built.
+    
+    Returns (stream, filename, quality, error_response); error_response is
+    None when the upload is valid.
+    """
+    file_target = UploadTarget()
+    quality_target = ValueTarget()
+    
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register('file', file_target)
+        parser.register('quality', quality_target)
+        while chunk := request.stream.read(COPY_BUFSIZE):
+            parser.data_received(chunk)
+    except RequestEntityTooLarge as e:
+        return None, None, None, file_too_large(e)
+    except UploadTooLarge:
+        # Check file size limit for Render.com memory optimization
+        return None, None, None, (json_response({
+            'success': False, 
+            'error': f'File too large. Maximum size: {MAX_CONTENT_LENGTH // (1024*1024)}MB'
+        }), 413)
+    except ParseFailedException:
+        return None, None, None, (json_response({'success': False, 'error': 'No file uploaded'}), 400)
+    
+    # Check if file was uploaded, a body cut off before the closing boundary never finishes the part
+    if file_target.multipart_filename is None or not file_target.finished:
+        return None, None, None, (json_response({'success': False, 'error': 'No file uploaded'}), 400)
+    
+    if file_target.multipart_filename == '':
+        return None, None, None, (json_response({'success': False, 'error': 'No file selected'}), 400)
+    
+    # Get compression quality
+    quality = quality_target.value.decode(errors='replace') or 'ebook'
+    if quality not in QUALITY_SETTINGS:
+        quality = 'ebook'
+    
+    logger.info(f"📁 Processing file: {file_target.multipart_filename} with {quality} quality")
+    
+    # Secure filename
+    filename = secure_filename(file_target.multipart_filename)
+    if not is_pdf_filename(filename):
+        return None, None, None, (json_response({'success': False, 'error': 'File must be a PDF'}), 400)
+    
+    return file_target.stream, filename, quality, None
+
+def remove_files_older_than(folder, cutoff_ts, label):
+    """Single scandir pass removing regular files last changed before cutoff_ts"""
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            # st_ctime, not st_mtime: hard-linking a reused result bumps ctime
+            # but leaves the shared inode's original mtime in place
+            if entry.is_file(follow_symlinks=False) and entry.stat().st_ctime < cutoff_ts:
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    continue  # Removed by another worker's cleanup
+                logger.info(f"🗑️ Cleaned up {label}: {entry.name}")
+
 def cleanup_old_files():
     """Remove files older than 1 hour"""
     try:
-        cutoff_time = datetime.now() - timedelta(hours=1)
-        
-        # Clean upload folder
-        for filename in os.listdir(UPLOAD_FOLDER):
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.isfile(filepath):
-                file_time = datetime.fromtimestamp(os.path.getmtime(filepath))
-                if file_time < cutoff_time:
-                    os.remove(filepath)
-                    logger.info(f"🗑️ Cleaned up upload: {filename}")
-        
-        # Clean compressed folder
-        for filename in os.listdir(COMPRESSED_FOLDER):
-            filepath = os.path.join(COMPRESSED_FOLDER, filename)
-            if os.path.isfile(filepath):
-                file_time = datetime.fromtimestamp(os.path.getmtime(filepath))
-                if file_time < cutoff_time:
-                    os.remove(filepath)
-                    logger.info(f"🗑️ Cleaned up compressed: {filename}")
-        
-        # Clean memory store
-        to_remove = []
-        for file_id, info in compressed_files.items():
-            if info['created'] < cutoff_time:
-                to_remove.append(file_id)
-        
-        for file_id in to_remove:
-            del compressed_files[file_id]
-            
-        logger.info(f"🧹 Cleanup completed: removed {len(to_remove)} expired entries")
+        cutoff_ts = time.time() - 3600
+        
+        # Expire stored files in one indexed statement
+        with db_lock:
+            expired = db.execute(
+                'DELETE FROM files WHERE created < ? RETURNING compressed_path',
+                (cutoff_ts,)
+            ).fetchall()
+        
+        for row in expired:
+            try:
+                os.remove(row['compressed_path'])
+            except FileNotFoundError:
+                pass
+        
+        # Clean compressed folder (orphans without a stored entry)
+        remove_files_older_than(COMPRESSED_FOLDER, cutoff_ts, 'compressed')
+        
+        logger.info(f"🧹 Cleanup completed: removed {len(expired)} expired entries")
         
     except Exception as e:
         logger.error(f"❌ Cleanup error: {str(e)}")
@@ -235,11 +656,14 @@ def start_cleanup_scheduler():
     cleanup_thread.start()
     logger.info("🕒 Cleanup scheduler started")
 
+# Start cleanup scheduler in every process, gunicorn workers never run __main__
+start_cleanup_scheduler()
+
 # Routes
 @app.route('/', methods=['GET'])
 def index():
     """API information"""
-    return jsonify({
+    return json_response({
         'service': 'QuickUtil PDF Compression API',
         'version': '2.1.0',
         'platform': 'Render.com',
@@ -247,6 +671,7 @@ def index():
         'endpoints': {
             'health': '/health',
             'compress': '/compress',
+            'compress_stream': '/compress-stream',
             'download': '/download/<file_id>'
         }
     })
@@ -254,7 +679,7 @@ def index():
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
+    return json_response({
         'status': 'healthy',
         'service': 'QuickUtil PDF Compression API',
         'version': '2.1.0',
@@ -267,79 +692,56 @@ def health_check():
 def compress_pdf():
     """Compress PDF file using Ghostscript"""
     try:
-        # Check if file was uploaded
-        if 'file' not in request.files:
-            return jsonify({'success': False, 'error': 'No file uploaded'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'success': False, 'error': 'No file selected'}), 400
-        
-        # Get compression quality
-        quality = request.form.get('quality', 'ebook')
-        if quality not in ['screen', 'ebook', 'printer', 'prepress']:
-            quality = 'ebook'
-        
-        logger.info(f"📁 Processing file: {file.filename} with {quality} quality")
-        
-        # Secure filename
-        filename = secure_filename(file.filename)
-        if not filename.lower().endswith('.pdf'):
-            return jsonify({'success': False, 'error': 'File must be a PDF'}), 400
+        upload_stream, filename, quality, error_response = get_pdf_upload()
+        if error_response:
+            return error_response
         
         # Generate unique IDs
         upload_id = str(uuid.uuid4())
         compress_id = str(uuid.uuid4())
         
-        # Save uploaded file
-        upload_path = os.path.join(UPLOAD_FOLDER, f"{upload_id}_{filename}")
-        file.save(upload_path)
-        
-        # Get original file size and check limits
-        original_size = os.path.getsize(upload_path)
-        logger.info(f"📊 Original file size: {original_size} bytes")
-        
-        # Check file size limit for Render.com memory optimization
-        if original_size > MAX_CONTENT_LENGTH:
-            if os.path.exists(upload_path):
-                os.remove(upload_path)
-            return jsonify({
-                'success': False, 
-                'error': f'File too large. Maximum size: {MAX_CONTENT_LENGTH // (1024*1024)}MB'
-            }), 413
-        
         # Check Ghostscript availability
         if not is_ghostscript_available():
-            return jsonify({
+            return json_response({
                 'success': False, 
                 'error': 'Ghostscript not available on server'
             }), 500
         
-        # Compress file
+        # Compressed output path
         compressed_filename = f"compressed_{upload_id}_{filename}"
         compressed_path = os.path.join(COMPRESSED_FOLDER, compressed_filename)
         
+        # Fingerprint the upload first so a repeat can skip Ghostscript entirely
+        original_size = upload_stream.getbuffer().nbytes
+        digest = fingerprint_upload(upload_stream)
+        logger.info(f"📊 Original file size: {original_size} bytes")
+        
         compression_start = time.time()
-        compression_success = compress_pdf_ghostscript(upload_path, compressed_path, quality)
+        if link_cached_compression(digest, quality, compressed_path):
+            logger.info("♻️ Identical upload already compressed, reusing result")
+            compression_success = True
+        else:
+            try:
+                compression_success = compress_pdf_ghostscript(upload_stream, compressed_path, quality)
+            except ServerBusy:
+                return json_response({
+                    'success': False, 
+                    'error': 'Server busy, please retry shortly'
+                }), 503
         compression_time = time.time() - compression_start
         
         if not compression_success:
-            # Clean up upload file
-            if os.path.exists(upload_path):
-                os.remove(upload_path)
             # Clean up any partial compressed file
             if os.path.exists(compressed_path):
                 os.remove(compressed_path)
-            return jsonify({
+            return json_response({
                 'success': False, 
                 'error': 'PDF compression failed - file may be corrupted or too complex'
             }), 500
         
         # Check if compressed file exists and get size
         if not os.path.exists(compressed_path):
-            if os.path.exists(upload_path):
-                os.remove(upload_path)
-            return jsonify({
+            return json_response({
                 'success': False, 
                 'error': 'Compressed file not created'
             }), 500
@@ -350,22 +752,14 @@ def compress_pdf():
         logger.info(f"✅ Compression successful: {original_size} → {compressed_size} bytes ({compression_ratio:.1f}% reduction)")
         
         # Store file info
-        compressed_files[compress_id] = {
-            'original_filename': filename,
-            'compressed_path': compressed_path,
-            'original_size': original_size,
-            'compressed_size': compressed_size,
-            'compression_ratio': compression_ratio,
-            'quality': quality,
-            'compression_time': compression_time,
-            'created': datetime.now()
-        }
-        
-        # Clean up upload file
-        if os.path.exists(upload_path):
-            os.remove(upload_path)
+        with db_lock:
+            db.execute(
+                'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (compress_id, compressed_path, time.time(), filename, original_size,
+                 compressed_size, compression_ratio, quality, compression_time, digest)
+            )
         
-        return jsonify({
+        return json_response({
             'success': True,
             'download_id': compress_id,
             'original_size': original_size,
@@ -377,7 +771,77 @@ def compress_pdf():
         
     except Exception as e:
         logger.error(f"❌ Compression error: {str(e)}")
-        return jsonify({
+        return json_response({
+            'success': False, 
+            'error': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/compress-stream', methods=['POST'])
+def compress_pdf_stream():
+    """Compress PDF file and stream the result back in the same response"""
+    try:
+        upload_stream, filename, quality, error_response = get_pdf_upload()
+        if error_response:
+            return error_response
+        
+        # Check Ghostscript availability
+        if not is_ghostscript_available():
+            return json_response({
+                'success': False, 
+                'error': 'Ghostscript not available on server'
+            }), 500
+        
+        # Ghostscript reads the upload from stdin and writes the PDF to stdout
+        logger.info(f"🔧 Streaming compression with Ghostscript: {quality} quality")
+        original_size = upload_stream.getbuffer().nbytes
+        try:
+            job = GhostscriptJob(upload_stream, quality)
+        except ServerBusy:
+            return json_response({
+                'success': False, 
+                'error': 'Server busy, please retry shortly'
+            }), 503
+        
+        # A short first read means gs already closed stdout, so its exit status
+        # is known before anything is sent and failures still get a JSON error
+        first_chunk = job.stdout.read(STREAM_CHUNK_SIZE)
+        if len(first_chunk) < STREAM_CHUNK_SIZE:
+            success, stderr = job.finish()
+            if not success:
+                logger.error(f"❌ Ghostscript compression failed: {stderr}")
+                return json_response({
+                    'success': False, 
+                    'error': 'PDF compression failed - file may be corrupted or too complex'
+                }), 500
+            logger.info(f"✅ Streamed compression successful: {original_size} bytes in")
+            response = Response(first_chunk, mimetype='application/pdf')
+            response.headers['Content-Disposition'] = f'attachment; filename="compressed_{filename}"'
+            return response
+        
+        def generate():
+            finished = False
+            try:
+                chunk = first_chunk
+                while chunk:
+                    yield chunk
+                    chunk = job.stdout.read(STREAM_CHUNK_SIZE)
+                success, stderr = job.finish()
+                finished = True
+                if success:
+                    logger.info(f"✅ Streamed compression successful: {original_size} bytes in")
+                else:
+                    logger.error(f"❌ Streamed compression failed: {stderr}")
+            finally:
+                if not finished:
+                    job.abort()
+        
+        response = Response(stream_with_context(generate()), mimetype='application/pdf')
+        response.headers['Content-Disposition'] = f'attachment; filename="compressed_{filename}"'
+        return response
+        
+    except Exception as e:
+        logger.error(f"❌ Compression error: {str(e)}")
+        return json_response({
             'success': False, 
             'error': f'Server error: {str(e)}'
         }), 500
@@ -386,38 +850,46 @@ def compress_pdf():
 def download_file(file_id):
     """Download compressed PDF file"""
     try:
-        if file_id not in compressed_files:
-            return jsonify({'error': 'File not found or expired'}), 404
+        with db_lock:
+            file_info = db.execute('SELECT * FROM files WHERE id = ?', (file_id,)).fetchone()
+        
+        if file_info is None:
+            return json_response({'error': 'File not found or expired'}), 404
         
-        file_info = compressed_files[file_id]
         compressed_path = file_info['compressed_path']
         
         if not os.path.exists(compressed_path):
-            # Remove from memory if file doesn't exist
-            del compressed_files[file_id]
-            return jsonify({'error': 'File not found on disk'}), 404
+            # Remove stored entry if file doesn't exist
+            with db_lock:
+                db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+            return json_response({'error': 'File not found on disk'}), 404
         
         logger.info(f"📤 Downloading file: {file_info['original_filename']}")
+        download_name = f"compressed_{file_info['original_filename']}"
+        
+        if X_ACCEL_REDIRECT_PREFIX:
+            # Let nginx serve the file from COMPRESSED_FOLDER with sendfile
+            response = Response(mimetype='application/pdf')
+            response.headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX + os.path.basename(compressed_path)
+            response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+            return response
         
         return send_file(
             compressed_path,
             as_attachment=True,
-            download_name=f"compressed_{file_info['original_filename']}",
+            download_name=download_name,
             mimetype='application/pdf'
         )
         
     except Exception as e:
         logger.error(f"❌ Download error: {str(e)}")
-        return jsonify({'error': f'Download failed: {str(e)}'}), 500
+        return json_response({'error': f'Download failed: {str(e)}'}), 500
 
 @app.errorhandler(413)
 def file_too_large(e):
-    return jsonify({'success': False, 'error': 'File too large (max 5MB)'}), 413
+    return json_response({'success': False, 'error': 'File too large (max 5MB)'}), 413
 
 if __name__ == '__main__':
-    # Start cleanup scheduler
-    start_cleanup_scheduler()
-    
     # Run app
     port = int(os.environ.get('PORT', 5000))
     logger.info(f"🚀 Starting QuickUtil PDF Compression API on port {port}")